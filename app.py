@@ -1,14 +1,27 @@
-import html
+import hashlib
 import json
+import queue
+import re
+import threading
+from bisect import bisect_left, bisect_right, insort
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from random import choice
-from time import sleep
-from typing import List, Tuple
+from time import monotonic, sleep
+from typing import Dict, Iterator, List, Optional, Tuple
+from uuid import uuid4
 
+import httpx
 import requests
 import streamlit as st
-from langchain_core.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
-from pydantic import BaseModel
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    # Fallback alla libreria standard se orjson non è installato
+    orjson = None
 
 # ============================================================================
 # CONFIGURAZIONE E MODELLI
@@ -26,106 +39,719 @@ def get_secret(key: str, default: str = "") -> str:
         return os.getenv(key, default)
 
 
-class MessageResponse(BaseModel):
-    """Risposta del modello OpenAI con messaggi suddivisi"""
-
-    messages: List[str]
-
-
 # ============================================================================
 # CACHE E RISORSE
 # ============================================================================
 
 
+OPENAI_CHAT_MODEL = "gpt-4.1-mini"
+OPENAI_TEMPERATURE = 0.2
+
+AI_SYSTEM_PROMPT = """Sei un assistente esperto e disponibile. Rispondi alla domanda dell'utente in modo chiaro come se fossi un professore universitario di Topologia Generale. Se la domanda riguarda argomenti di studio, fornisci spiegazioni 
+dettagliate ma comprensibili. Non scrivere formule in markdown. Scrivi in testo semplice, senza elenchi né
+formattazione, e mantieni la risposta concisa (al massimo circa 600 caratteri).
+Il topic principale delle domande riguarda la Topologia Generale, tu devi rispondere comunque a tutto. Limitati a rispondere alla domanda e non proporre approfondimenti o altro alla fine della risposta. Non specificare che parli di Topologia Generale, rispondi solo alla domanda."""
+AI_QUESTION_TEMPLATE = "Domanda: {question}"
+
+
+@st.cache_resource
+def get_openai_http_client() -> httpx.Client:
+    """Crea e cache il client HTTP condiviso dalle chiamate a OpenAI
+
+    Chat e embedding usano lo stesso pool di connessioni verso api.openai.com,
+    che resta aperto per tutta la vita del worker.
+    """
+    return httpx.Client()
+
+
+@st.cache_resource
+def get_openai_client():
+    """Crea e cache il client OpenAI usato per la Batch API"""
+    from openai import OpenAI
+
+    return OpenAI(http_client=get_openai_http_client())
+
+
 @st.cache_resource
 def get_llm_chain():
-    """Crea e cache la chain LLM per evitare ricaricamenti"""
-    prompt_template = PromptTemplate.from_template(
-        """Sei un assistente esperto e disponibile. Rispondi alla seguente domanda in modo chiaro come se fossi un professore universitario di Topologia Generale. Se la domanda riguarda argomenti di studio, fornisci spiegazioni 
-dettagliate ma comprensibili. Non scrivere formule in markdown. Se il messaggio di risposta è
-troppo lungo, suddividilo in più messaggi di massimo 120 caratteri ciascuno. Non fare messaggi eccessivamente corti se
-decidi di suddividerlo e cerca di non fare più di 5 messaggi in totale (da 1 a 5 messaggi massimo). Se puoi mandare un solo messaggio fallo.
-Il topic principale delle domande riguarda la Topologia Generale, tu devi rispondere comunque a tutto. Limitati a rispondere alla domanda e non proporre approfondimenti o altro alla fine della risposta. Non specificare che parli di Topologia Generale, rispondi solo alla domanda.
+    """Crea e cache la chain LLM per evitare ricaricamenti
 
-Domanda: {question}
+    Le domande già poste (anche riformulate) sono risolte dalla cache
+    semantica prima di arrivare alla chain, sia in streaming sia in batch.
+    """
+    # Import locali: LangChain è pesante da caricare e serve solo per l'AI
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_openai import ChatOpenAI
+
+    # Istruzioni statiche nel messaggio di sistema, solo la domanda varia:
+    # il prefisso identico fra le richieste sfrutta il prompt caching di OpenAI
+    prompt_template = ChatPromptTemplate.from_messages(
+        [("system", AI_SYSTEM_PROMPT), ("human", AI_QUESTION_TEMPLATE)]
+    )
 
-Risposta:"""
+    llm = ChatOpenAI(
+        model=OPENAI_CHAT_MODEL,
+        temperature=OPENAI_TEMPERATURE,
+        # Anche invoke/batch ricevono i token in streaming: la connessione non
+        # resta muta fino alla fine della generazione (evita timeout dei gateway)
+        streaming=True,
+        max_retries=3,
+        timeout=30,
+        http_client=get_openai_http_client(),
     )
+    return prompt_template | llm
 
-    llm = ChatOpenAI(model="gpt-4.1-mini", temperature=0.2)
-    return prompt_template | llm.with_structured_output(MessageResponse)
 
+# Distanza coseno massima perché due domande siano considerate equivalenti
+SEMANTIC_CACHE_MAX_DISTANCE = 0.08
+# Cartella della cache semantica su disco: le risposte sopravvivono ai riavvii
+SEMANTIC_CACHE_PATH = ".semantic_cache"
+
+
+@st.cache_resource
+def get_semantic_cache():
+    """Crea e cache l'encoder e la collezione vettoriale della cache semantica
 
-@st.cache_data
+    La collezione è salvata su disco, così dopo un riavvio (o un nuovo deploy)
+    le domande già viste riusano le risposte senza richiamare OpenAI.
+
+    Returns:
+        Tupla (encoder degli embedding, collezione chromadb persistente)
+    """
+    import chromadb
+    from langchain_openai import OpenAIEmbeddings
+
+    embeddings = OpenAIEmbeddings(
+        model="text-embedding-3-small", http_client=get_openai_http_client()
+    )
+    collection = chromadb.PersistentClient(path=SEMANTIC_CACHE_PATH).get_or_create_collection(
+        "qa_cache", metadata={"hnsw:space": "cosine"}
+    )
+    return embeddings, collection
+
+
+CONCEPT_MAP_PATH = "concept_map.json"
+# Pulsanti per riga nella vista di una categoria
+CATEGORY_COLS_PER_ROW = 3
+
+
+@st.cache_resource
 def load_concept_map(json_path: str):
-    """Carica la mappa concettuale dal file JSON"""
-    with open(json_path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    """Carica la mappa concettuale dal file JSON e ne costruisce gli indici
 
+    Cachata come risorsa: indici e mappa sono condivisi in sola lettura e non
+    vengono copiati (de-serializzati) a ogni rerun come con st.cache_data.
+
+    Returns:
+        Tupla (radice, indice percorso -> nodo, indice percorso -> righe dei
+        figli, percorsi delle foglie), dove ogni riga raggruppa fino a
+        CATEGORY_COLS_PER_ROW terne (chiave, icona, nome visualizzato) già
+        pronte per i pulsanti della categoria
+    """
+    if orjson is not None:
+        with open(json_path, "rb") as f:
+            root = orjson.loads(f.read())
+    else:
+        with open(json_path, "r", encoding="utf-8") as f:
+            root = json.load(f)
+
+    path_index = {(): root}
+    children_ui = {}
+    leaf_paths = set()
+    stack = [((), root)]
+    while stack:
+        path, node = stack.pop()
+        children = get_children(node)
+        if is_leaf(node):
+            leaf_paths.add(path)
+        elif children:
+            buttons = tuple(
+                (
+                    key,
+                    "📄" if is_leaf(child) else "📁",
+                    child.get("title", key) if isinstance(child, dict) else key,
+                )
+                for key, child in children.items()
+            )
+            children_ui[path] = tuple(
+                buttons[i : i + CATEGORY_COLS_PER_ROW]
+                for i in range(0, len(buttons), CATEGORY_COLS_PER_ROW)
+            )
+            for key, child in children.items():
+                path_index[path + (key,)] = child
+                stack.append((path + (key,), child))
+
+    return root, path_index, children_ui, frozenset(leaf_paths)
+
+
+@st.cache_resource(show_spinner=False)
+def _cached_collect_all_leaves(
+    json_path: str,
+) -> Tuple[Tuple[str, ...], Tuple[str, ...], Tuple[Tuple[str, Tuple[str, ...], str], ...]]:
+    """Raccoglie e cachea tutte le foglie della mappa caricata da json_path
+
+    La chiave della cache è il percorso del file (hashable e stabile) invece
+    del dizionario della mappa, che andrebbe ri-hashato a ogni rerun. Le tuple
+    sono immutabili e condivise come risorsa: a ogni ricerca non vengono
+    copiate (de-serializzate) come con st.cache_data.
+    La visita è iterativa (stack esplicito), in un solo passaggio e nello
+    stesso ordine della visita in profondità; titoli e messaggi sono già
+    convertiti in minuscolo per la ricerca.
 
-@st.cache_data
-def get_all_leaves(concept_map) -> List[Tuple[str, List[str], str]]:
-    """Raccoglie e cachea tutte le foglie del grafo
-    
     Returns:
-        List di tuple (titolo, percorso, messaggio)
+        Tupla (titoli minuscoli, messaggi minuscoli, foglie), dove le foglie
+        sono tuple (titolo, percorso, messaggio) con percorso immutabile
     """
-    return collect_all_leaves(concept_map)
+    entries = []
+    root, _, _, _ = load_concept_map(json_path)
+    stack = [(root, ())]
+
+    while stack:
+        node, path = stack.pop()
+        if is_leaf(node):
+            entries.append((node.get("title", "Senza titolo"), path, node.get("message", "")))
+        elif isinstance(node, dict) and "children" in node:
+            # Inseriti al contrario per visitarli nell'ordine originale
+            stack.extend((child, path + (key,)) for key, child in reversed(node["children"].items()))
+
+    titles_lower = tuple(title.lower() for title, _, _ in entries)
+    messages_lower = tuple(message.lower() for _, _, message in entries)
+    return titles_lower, messages_lower, tuple(entries)
 
 
 # ============================================================================
 # FUNZIONI TELEGRAM
 # ============================================================================
 
+# Limiti documentati da Telegram: 30 msg/s globali e circa 1 msg/s per chat
+# (con brevi raffiche tollerate)
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_CHAT_RATE = 1.0
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_MAX_ATTEMPTS = 3
+# Timeout separati: connessione breve (fallisce presto), lettura più lunga
+TELEGRAM_CONNECT_TIMEOUT = 3.05
+TELEGRAM_READ_TIMEOUT = 10
+
+
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """Crea e cache la sessione HTTP verso api.telegram.org
+
+    Keep-alive e pool di connessioni sopravvivono a tutti i rerun del worker;
+    le connessioni non riuscite vengono ritentate con backoff esponenziale.
+    I rate limit (429) sono gestiti da send_telegram_message: Telegram indica
+    l'attesa nel corpo JSON (parameters.retry_after), che urllib3 non legge.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=3,
+            # Niente tentativi dopo che la richiesta è partita (errori di lettura,
+            # 5xx del gateway): Telegram potrebbe aver già consegnato il
+            # messaggio e sendMessage non è idempotente, si avrebbero doppioni
+            read=0,
+            backoff_factor=0.5,
+            # sendMessage è una POST: di default urllib3 non la ritenterebbe
+            allowed_methods=["POST"],
+        ),
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+class TelegramRateLimiter:
+    """Stato condiviso del rate limiter Telegram
+
+    Ogni chat ha un token bucket (raffica di TELEGRAM_CHAT_BURST messaggi, poi
+    TELEGRAM_CHAT_RATE msg/s); in più si tengono, ordinati, gli orari degli
+    invii prenotati per non superare il limite globale di 30 msg/s. I lock per
+    chat serializzano gli invii verso la stessa chat (l'ordine dei messaggi va
+    preservato) e il semaforo limita a 30 le richieste contemporanee.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._chat_buckets: Dict[str, Tuple[float, float]] = {}
+        self._send_times: List[float] = []
+        self._chat_locks: Dict[str, threading.Lock] = {}
+        self.semaphore = threading.BoundedSemaphore(TELEGRAM_GLOBAL_RATE)
+
+    def chat_lock(self, chat_id: str) -> threading.Lock:
+        """Ritorna il lock associato a una chat, creandolo se necessario"""
+        with self._lock:
+            return self._chat_locks.setdefault(chat_id, threading.Lock())
+
+    def reserve(self, chat_id: str) -> float:
+        """Prenota uno slot di invio e ritorna i secondi da attendere prima di inviare"""
+        with self._lock:
+            now = monotonic()
+            tokens, last = self._chat_buckets.get(chat_id, (TELEGRAM_CHAT_BURST, now))
+            tokens = min(TELEGRAM_CHAT_BURST, tokens + (now - last) * TELEGRAM_CHAT_RATE)
+            send_at = now + max(0.0, (1 - tokens) / TELEGRAM_CHAT_RATE)
+            self._chat_buckets[chat_id] = (tokens - 1, now)
+
+            # Le prenotazioni non arrivano in ordine di orario (chat diverse
+            # hanno attese diverse): la lista è tenuta ordinata e nessun
+            # intervallo di 1 s attorno all'invio può superare il limite globale
+            del self._send_times[: bisect_right(self._send_times, now - 1.0)]
+            first = bisect_right(self._send_times, send_at - 1.0)
+            while bisect_left(self._send_times, send_at + 1.0) - first >= TELEGRAM_GLOBAL_RATE:
+                # Slitta a 1 s dopo l'invio più vecchio della finestra
+                send_at = max(send_at, self._send_times[first] + 1.0)
+                first += 1
+            insort(self._send_times, send_at)
+
+            return send_at - now
+
+
+@st.cache_resource
+def get_telegram_limiter() -> TelegramRateLimiter:
+    """Crea e cache il rate limiter, condiviso fra sessioni e rerun"""
+    return TelegramRateLimiter()
+
+
+def _retry_after(response: requests.Response) -> float:
+    """Estrae il tempo di attesa suggerito da Telegram in una risposta 429"""
+    try:
+        return float(response.json()["parameters"]["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        return 1.0
+
+
+# Riconosce testo che Telegram potrebbe interpretare come tag HTML
+_HAS_HTML = re.compile(r"<[a-zA-Z/]").search
+
+# Tabella di escape equivalente a html.escape, applicata in C da str.translate
+_HTML_ESCAPE_TABLE = str.maketrans(
+    {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"}
+)
+
+
+def _telegram_request(bot_token: str, chat_id: str, message: str) -> Tuple[str, dict]:
+    """Costruisce URL e payload per l'invio di un messaggio
+
+    Il parse_mode HTML (con escape) serve solo se il testo contiene qualcosa
+    che somiglia a un tag; altrimenti il messaggio parte come testo semplice.
+    """
+    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
+    if _HAS_HTML(message):
+        # Escape HTML special characters to prevent parsing errors
+        payload = {
+            "chat_id": chat_id,
+            "text": message.translate(_HTML_ESCAPE_TABLE),
+            "parse_mode": "HTML",
+        }
+    else:
+        payload = {"chat_id": chat_id, "text": message}
+    return url, payload
+
 
 def send_telegram_message(
     bot_token: str, chat_id: str, message: str
 ) -> Tuple[bool, str]:
-    """Invia un messaggio al bot Telegram"""
-    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    # Escape HTML special characters to prevent parsing errors
-    escaped_message = html.escape(message)
-    payload = {"chat_id": chat_id, "text": escaped_message, "parse_mode": "HTML"}
+    """Invia un messaggio al bot Telegram
+
+    Su un 429 attende il retry_after indicato da Telegram e ritenta, fino a
+    TELEGRAM_MAX_ATTEMPTS tentativi; ogni tentativo passa dal rate limiter.
+    """
+    url, payload = _telegram_request(bot_token, chat_id, message)
     try:
-        response = requests.post(url, json=payload)
+        limiter = get_telegram_limiter()
+        for attempt in range(1, TELEGRAM_MAX_ATTEMPTS + 1):
+            delay = limiter.reserve(chat_id)
+            if delay > 0:
+                sleep(delay)
+            with limiter.semaphore:
+                response = get_http_session().post(
+                    url, json=payload, timeout=(TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT)
+                )
+            if response.status_code != 429 or attempt == TELEGRAM_MAX_ATTEMPTS:
+                break
+            sleep(_retry_after(response))
         response.raise_for_status()
         return True, "Messaggio inviato con successo!"
     except Exception as e:
         return False, f"Errore nell'invio: {str(e)}"
 
 
-def send_multiple_telegram_messages(
-    bot_token: str, chat_id: str, messages: List[str]
-) -> Tuple[bool, str]:
-    """Invia più messaggi in sequenza al bot Telegram"""
-    failed_messages = []
-
-    for i, message in enumerate(messages):
-        success, error_msg = send_telegram_message(bot_token, chat_id, message)
-        sleep(0.5)  # Pausa per evitare rate limiting
-        if not success:
-            failed_messages.append((i + 1, error_msg))
-
+def _summarize_sends(total: int, failed_messages: List[Tuple[int, str]]) -> Tuple[bool, str]:
+    """Riassume l'esito di un invio multiplo nel formato (successo, messaggio)"""
     if not failed_messages:
-        return True, f"Tutti i {len(messages)} messaggi inviati con successo!"
+        return True, f"Tutti i {total} messaggi inviati con successo!"
     else:
         error_details = "; ".join([f"Msg {num}: {err}" for num, err in failed_messages])
         return False, f"Errori nell'invio: {error_details}"
 
 
+def send_telegram_messages_from_queue(
+    bot_token: str, chat_id: str, message_queue: "queue.Queue[Optional[str]]"
+) -> Tuple[bool, str]:
+    """Invia in ordine i messaggi letti dalla coda finché non riceve None
+
+    Pensata per girare in background: i messaggi possono essere accodati
+    mentre quelli successivi sono ancora in preparazione.
+    """
+    total = 0
+    failed_messages = []
+    with get_telegram_limiter().chat_lock(chat_id):
+        while (message := message_queue.get()) is not None:
+            total += 1
+            success, error_msg = send_telegram_message(bot_token, chat_id, message)
+            if not success:
+                failed_messages.append((total, error_msg))
+    return _summarize_sends(total, failed_messages)
+
+
+# Thread di invio in background condivisi fra sessioni e rerun
+TELEGRAM_SENDER_WORKERS = 8
+# Parti massime in cui viene divisa una risposta dell'AI per Telegram
+AI_MAX_TELEGRAM_PARTS = 5
+# Attesa massima per l'esito di un invio in background (domanda all'AI più le
+# parti della risposta): il ritmo imposto dal rate limiter a quei messaggi
+# più il timeout di una singola richiesta
+TELEGRAM_SENDER_TIMEOUT = (
+    (1 + AI_MAX_TELEGRAM_PARTS - TELEGRAM_CHAT_BURST) / TELEGRAM_CHAT_RATE
+    + TELEGRAM_CONNECT_TIMEOUT
+    + TELEGRAM_READ_TIMEOUT
+)
+
+
+@st.cache_resource
+def get_telegram_executor() -> ThreadPoolExecutor:
+    """Crea e cache il pool di thread per gli invii Telegram in background"""
+    return ThreadPoolExecutor(
+        max_workers=TELEGRAM_SENDER_WORKERS, thread_name_prefix="telegram-sender"
+    )
+
+
+def start_telegram_sender(
+    bot_token: str, chat_id: str
+) -> Tuple["queue.Queue[Optional[str]]", "Future[Tuple[bool, str]]"]:
+    """Avvia un invio in background alimentato da una coda
+
+    Returns:
+        Tupla (coda in cui accodare i messaggi, terminata da None; future con
+        l'esito dell'invio)
+    """
+    message_queue: "queue.Queue[Optional[str]]" = queue.Queue()
+    # Il thread torna libero nel pool quando la coda viene chiusa
+    future = get_telegram_executor().submit(
+        send_telegram_messages_from_queue, bot_token, chat_id, message_queue
+    )
+    return message_queue, future
+
+
 # ============================================================================
 # FUNZIONI OPENAI
 # ============================================================================
 
 
-def ask_openai(question: str) -> Tuple[bool, List[str] | str]:
-    """Interroga OpenAI con una domanda e ritorna la risposta"""
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def _split_for_telegram(
+    text: str, max_len: int = 120, max_msgs: int = AI_MAX_TELEGRAM_PARTS
+) -> List[str]:
+    """Suddivide una risposta in messaggi di al più max_len caratteri
+
+    Le frasi vengono accorpate finché stanno nel limite; quelle troppo lunghe
+    sono spezzate per parole. Oltre max_msgs messaggi, il resto del testo
+    confluisce nell'ultimo messaggio.
+    """
+    pieces = []
+    for sentence in _SENTENCE_END.split(text.strip()):
+        if len(sentence) <= max_len:
+            pieces.append(sentence)
+        else:
+            pieces.extend(sentence.split())
+
+    messages: List[str] = []
+    for piece in pieces:
+        if messages and len(messages[-1]) + 1 + len(piece) <= max_len:
+            messages[-1] += " " + piece
+        elif piece:
+            messages.append(piece)
+
+    if len(messages) > max_msgs:
+        messages[max_msgs - 1 :] = [" ".join(messages[max_msgs - 1 :])]
+    return messages
+
+
+def normalize_question(question: str) -> str:
+    """Normalizza una domanda (spazi e maiuscole) prima di calcolarne l'embedding"""
+    return " ".join(question.split()).lower()
+
+
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
+def embed_question(question: str) -> List[float]:
+    """Calcola l'embedding di una domanda normalizzata, memorizzandolo
+
+    Una domanda ripetuta non richiede un nuovo embedding: la ricerca nella
+    cache semantica (locale) trova subito la risposta senza alcuna chiamata
+    di rete. Gli errori non vengono memorizzati.
+    """
+    embeddings, _ = get_semantic_cache()
+    return embeddings.embed_query(question)
+
+
+def lookup_semantic_cache(embedding: List[float]) -> Optional[List[str]]:
+    """Cerca nella cache semantica una risposta già data a una domanda simile
+
+    Le domande vanno passate a normalize_question prima di calcolarne
+    l'embedding, così ogni percorso (singolo o batch) cerca allo stesso modo.
+
+    Returns:
+        I messaggi della risposta se la domanda più vicina è entro
+        SEMANTIC_CACHE_MAX_DISTANCE, altrimenti None
+    """
+    _, collection = get_semantic_cache()
+    result = collection.query(query_embeddings=[embedding], n_results=1)
+    distances, metadatas = result["distances"][0], result["metadatas"][0]
+    if distances and distances[0] < SEMANTIC_CACHE_MAX_DISTANCE:
+        return json.loads(metadatas[0]["messages"])
+    return None
+
+
+def store_semantic_cache(
+    embedding: List[float], messages: List[str], entry_id: Optional[str] = None
+) -> None:
+    """Salva nella cache semantica la risposta associata all'embedding di una domanda
+
+    Args:
+        entry_id: Identificativo della voce; di default ne viene generato uno
+            casuale, un id stabile evita di salvare due volte la stessa domanda
+    """
+    _, collection = get_semantic_cache()
+    collection.add(
+        ids=[entry_id or str(uuid4())],
+        embeddings=[embedding],
+        metadatas=[{"messages": json.dumps(messages)}],
+    )
+
+
+def ask_openai_stream(question: str) -> Iterator[str]:
+    """Interroga OpenAI restituendo la risposta man mano che viene generata
+
+    Le domande simili a una già posta producono subito la risposta in cache;
+    a fine generazione la nuova risposta viene salvata nella cache semantica.
+    Se la cache semantica non è disponibile (embedding o chromadb in errore)
+    la domanda va comunque al modello: la cache non blocca mai la risposta.
+    """
     try:
-        chain = get_llm_chain()
-        response: MessageResponse = chain.invoke({"question": question})  # type: ignore
-        return True, response.messages
+        embedding = embed_question(normalize_question(question))
+        cached_messages = lookup_semantic_cache(embedding)
+    except Exception:
+        embedding = cached_messages = None
+    if cached_messages is not None:
+        yield " ".join(cached_messages)
+        return
+
+    parts = []
+    for chunk in get_llm_chain().stream({"question": question}):
+        if chunk.content:
+            parts.append(str(chunk.content))
+            yield parts[-1]
+
+    messages = _split_for_telegram("".join(parts))
+    # Una risposta vuota non va in cache: ogni domanda simile la riceverebbe
+    if embedding is not None and messages:
+        try:
+            store_semantic_cache(embedding, messages)
+        except Exception:
+            # La risposta è già stata mostrata anche se non è stato possibile salvarla
+            pass
+
+
+OPENAI_MAX_CONCURRENCY = 8
+
+
+def ask_openai_many(questions: List[str]) -> List[Tuple[bool, List[str] | str]]:
+    """Interroga OpenAI con più domande in parallelo tramite chain.batch
+
+    Le domande duplicate vengono poste una sola volta e gli embedding di tutte
+    sono calcolati con un'unica richiesta; quelle già presenti nella cache
+    semantica non richiamano il modello. Le restanti partono insieme (al
+    massimo OPENAI_MAX_CONCURRENCY alla volta): poche richieste parallele
+    riducono la latenza totale, ma ogni domanda resta una richiesta a sé e
+    conta sul limite di richieste al minuto (RPM), mentre i token consumati
+    (TPM) sono gli stessi delle chiamate singole.
+
+    Non ha chiamanti nell'interfaccia, che pone una domanda alla volta in
+    streaming: come submit_batch e retrieve_batch è un'API per script e
+    lavori non interattivi (es. pre-calcolare le risposte per le foglie),
+    da usare quando le risposte servono subito e non entro 24 ore. Le
+    risposte ottenute finiscono nella stessa cache semantica del modal.
+
+    Returns:
+        Per ogni domanda, nello stesso ordine, una tupla (successo, messaggi
+        della risposta oppure messaggio di errore)
+    """
+    unique_questions = list(dict.fromkeys(questions))
+    answers: Dict[str, Tuple[bool, List[str] | str]] = {}
+
+    try:
+        embeddings, _ = get_semantic_cache()
+        vectors = dict(
+            zip(
+                unique_questions,
+                embeddings.embed_documents([normalize_question(q) for q in unique_questions]),
+            )
+        )
+        for question, embedding in vectors.items():
+            cached_messages = lookup_semantic_cache(embedding)
+            if cached_messages is not None:
+                answers[question] = (True, cached_messages)
+
+        to_ask = [question for question in unique_questions if question not in answers]
+        responses = get_llm_chain().batch(
+            [{"question": question} for question in to_ask],
+            config={"max_concurrency": OPENAI_MAX_CONCURRENCY},
+            return_exceptions=True,
+        )
     except Exception as e:
-        return False, f"Errore nella chiamata a OpenAI: {str(e)}"
+        return [(False, f"Errore nella chiamata a OpenAI: {str(e)}")] * len(questions)
+
+    for question, response in zip(to_ask, responses):
+        if isinstance(response, Exception):
+            answers[question] = (False, f"Errore nella chiamata a OpenAI: {str(response)}")
+        else:
+            messages = _split_for_telegram(str(response.content))
+            answers[question] = (True, messages)
+            if not messages:
+                continue
+            try:
+                store_semantic_cache(vectors[question], messages)
+            except Exception:
+                # La risposta è valida anche se non è stato possibile salvarla
+                pass
+
+    return [answers[question] for question in questions]
+
+
+def batch_question_id(question: str) -> str:
+    """Identificativo stabile di una domanda all'interno dei batch OpenAI
+
+    Calcolato sulla domanda normalizzata, come la ricerca nella cache
+    semantica: domande che differiscono per spazi o maiuscole coincidono.
+    """
+    return hashlib.sha256(normalize_question(question).encode("utf-8")).hexdigest()[:32]
+
+
+def submit_batch(questions: List[str]) -> str:
+    """Invia le domande alla Batch API di OpenAI per l'elaborazione offline
+
+    Pensata per lavori non interattivi (es. pre-calcolare le risposte per
+    tutte le foglie): costa la metà delle chiamate dirette e usa un limite
+    di richieste separato, ma le risposte arrivano entro 24 ore.
+
+    Returns:
+        L'id del batch, da passare a retrieve_batch con le stesse domande
+    """
+    unique_questions: Dict[str, str] = {}
+    for question in questions:
+        unique_questions.setdefault(batch_question_id(question), question)
+
+    lines = [
+        json.dumps(
+            {
+                "custom_id": question_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": OPENAI_CHAT_MODEL,
+                    "temperature": OPENAI_TEMPERATURE,
+                    "messages": [
+                        {"role": "system", "content": AI_SYSTEM_PROMPT},
+                        {"role": "user", "content": AI_QUESTION_TEMPLATE.format(question=question)},
+                    ],
+                },
+            }
+        )
+        for question_id, question in unique_questions.items()
+    ]
+
+    client = get_openai_client()
+    batch_file = client.files.create(
+        file=("batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    return batch.id
+
+
+@st.cache_data(persist="disk", show_spinner=False)
+def _download_batch_results(output_file_id: str) -> Dict[str, List[str]]:
+    """Scarica e cachea su disco le risposte di un batch completato
+
+    Returns:
+        Dizionario id domanda (batch_question_id) -> messaggi della risposta
+    """
+    content = get_openai_client().files.content(output_file_id).text
+    results = {}
+    for line in content.splitlines():
+        record = json.loads(line)
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            continue
+        answer = response["body"]["choices"][0]["message"]["content"]
+        results[record["custom_id"]] = _split_for_telegram(answer)
+    return results
+
+
+def _store_batch_results(questions: List[str], results: Dict[str, List[str]]) -> None:
+    """Salva nella cache semantica le risposte di un batch non ancora presenti
+
+    L'id della voce è batch_question_id: le domande già salvate da una
+    chiamata precedente non vengono né ri-calcolate né duplicate.
+    """
+    to_store = {}
+    for question in questions:
+        question_id = batch_question_id(question)
+        if results.get(question_id):
+            to_store.setdefault(question_id, normalize_question(question))
+    if not to_store:
+        return
+
+    embeddings, collection = get_semantic_cache()
+    for question_id in collection.get(ids=list(to_store))["ids"]:
+        del to_store[question_id]
+    if not to_store:
+        return
+
+    vectors = embeddings.embed_documents(list(to_store.values()))
+    for question_id, embedding in zip(to_store, vectors):
+        store_semantic_cache(embedding, results[question_id], entry_id=question_id)
+
+
+def retrieve_batch(batch_id: str, questions: List[str]) -> Optional[Dict[str, List[str]]]:
+    """Recupera le risposte di un batch inviato con submit_batch
+
+    Le risposte vengono anche salvate nella cache semantica, così le stesse
+    domande poste dal modal AI non richiamano più il modello.
+
+    Args:
+        questions: Le domande passate a submit_batch
+
+    Returns:
+        Dizionario id domanda (batch_question_id) -> messaggi della risposta,
+        oppure None se il batch non è ancora completato
+    """
+    batch = get_openai_client().batches.retrieve(batch_id)
+    if batch.status != "completed" or not batch.output_file_id:
+        return None
+    results = _download_batch_results(batch.output_file_id)
+    try:
+        _store_batch_results(questions, results)
+    except Exception:
+        # Le risposte restano valide anche se non è stato possibile salvarle
+        pass
+    return results
 
 
 # ============================================================================
@@ -147,61 +773,9 @@ def get_children(node):
     return None
 
 
-def navigate_to_path(data, path: List[str]):
-    """Naviga nel dizionario seguendo il percorso specificato"""
-    current = data
-    for key in path:
-        if isinstance(current, dict):
-            if "children" in current and key in current["children"]:
-                current = current["children"][key]
-            else:
-                return None
-        else:
-            return None
-    return current
-
-
-def count_nodes(node) -> int:
-    """Conta il numero totale di nodi nella mappa"""
-    count = 0
-    if isinstance(node, dict):
-        if "children" in node:
-            for child in node["children"].values():
-                count += 1 + count_nodes(child)
-    return count
-
-
-def count_leaves(node) -> int:
-    """Conta il numero di foglie nella mappa"""
-    if is_leaf(node):
-        return 1
-    count = 0
-    if isinstance(node, dict) and "children" in node:
-        for child in node["children"].values():
-            count += count_leaves(child)
-    return count
-
-
-def collect_all_leaves(node, current_path: List[str] = []) -> List[Tuple[str, List[str], str]]:
-    """Raccoglie tutte le foglie con i loro percorsi e titoli
-    
-    Returns:
-        List di tuple (titolo, percorso, messaggio)
-    """
-    if current_path is None:
-        current_path = []
-    
-    leaves = []
-    
-    if is_leaf(node):
-        title = node.get("title", "Senza titolo")
-        message = node.get("message", "")
-        leaves.append((title, current_path.copy(), message))
-    elif isinstance(node, dict) and "children" in node:
-        for key, child in node["children"].items():
-            leaves.extend(collect_all_leaves(child, current_path + [key]))
-    
-    return leaves
+def navigate_to_path(path_index, path: Tuple[str, ...]):
+    """Ritorna il nodo al percorso specificato usando l'indice precalcolato"""
+    return path_index.get(path)
 
 
 # ============================================================================
@@ -224,12 +798,13 @@ def format_leaf_message(title: str, content: str) -> str:
     return f"{emoji} {title.upper()} {emoji}\n\n{content}"
 
 
-def render_search_bar(concept_map, telegram_bot_token: str = "", telegram_chat_id: str = ""):
+@st.fragment
+def render_search_bar(json_path: str, telegram_bot_token: str = "", telegram_chat_id: str = ""):
     """Renderizza la barra di ricerca globale per le foglie"""
     st.markdown("### 🔍 Ricerca Foglie")
     
     # Raccogli tutte le foglie (cached per performance)
-    all_leaves = get_all_leaves(concept_map)
+    titles_lower, messages_lower, all_leaves = _cached_collect_all_leaves(json_path)
     
     # Rendi disponibili i token per il pulsante di invio
     TELEGRAM_BOT_TOKEN = telegram_bot_token
@@ -244,17 +819,15 @@ def render_search_bar(concept_map, telegram_bot_token: str = "", telegram_chat_i
     )
     
     if search_query:
-        # Filtra le foglie che matchano la query
+        # Filtra le foglie che matchano la query (indici nell'elenco delle foglie)
+        query = search_query.lower()
         # Priorità 1: Match nel titolo
-        title_matches = [
-            (title, path, message) for title, path, message in all_leaves
-            if search_query.lower() in title.lower()
-        ]
+        title_matches = [i for i, title in enumerate(titles_lower) if query in title]
         
         # Priorità 2: Match nel messaggio (escludi quelli già trovati nel titolo)
         message_matches = [
-            (title, path, message) for title, path, message in all_leaves
-            if search_query.lower() not in title.lower() and search_query.lower() in message.lower()
+            i for i, (title, message) in enumerate(zip(titles_lower, messages_lower))
+            if query not in title and query in message
         ]
         
         # Combina i risultati con priorità
@@ -266,7 +839,8 @@ def render_search_bar(concept_map, telegram_bot_token: str = "", telegram_chat_i
                 st.caption(f"📌 {len(title_matches)} nel titolo, 💬 {len(message_matches)} nel messaggio")
             
             # Mostra i risultati in un container scrollabile
-            for idx, (title, path, message_content) in enumerate(matching_leaves[:10]):  # Limita a 10 risultati
+            for idx, leaf_idx in enumerate(matching_leaves[:10]):  # Limita a 10 risultati
+                title, path, message_content = all_leaves[leaf_idx]
                 path_str = " > ".join(path) if path else "Root"
                 
                 col1, col2, col3 = st.columns([3, 1, 1])
@@ -298,6 +872,7 @@ def render_search_bar(concept_map, telegram_bot_token: str = "", telegram_chat_i
         st.info(f"💡 Ci sono {len(all_leaves)} foglie totali. Inizia a digitare per cercare.")
 
 
+@st.fragment
 def render_ai_modal(
     openai_api_key: str, telegram_bot_token: str, telegram_chat_id: str
 ):
@@ -327,52 +902,69 @@ def render_ai_modal(
             cancel = st.form_submit_button("❌ Annulla", use_container_width=True)
 
         if submit and user_question.strip():
-            with st.spinner("🤔 L'AI sta pensando..."):
-                success, ai_response = ask_openai(user_question)
+            # Invia a Telegram se configurato: la domanda parte subito,
+            # in parallelo alla generazione della risposta
+            telegram_queue = telegram_sender = None
+            if telegram_bot_token and telegram_chat_id:
+                telegram_queue, telegram_sender = start_telegram_sender(
+                    telegram_bot_token, telegram_chat_id
+                )
 
-            if success:
-                st.success("✅ Risposta ricevuta!")
-                st.markdown("**Risposta dell'AI:**")
+            try:
+                if telegram_queue is not None:
+                    telegram_queue.put(f"❓ Domanda: {user_question}")
 
-                # Visualizza i messaggi
-                if isinstance(ai_response, list):
-                    for i, msg in enumerate(ai_response, 1):
-                        if len(ai_response) > 1:
-                            st.info(f"**Parte {i}/{len(ai_response)}:** {msg}")
+                st.markdown("**Risposta dell'AI:**")
+                try:
+                    with st.spinner("🤔 L'AI sta pensando..."):
+                        answer = st.write_stream(ask_openai_stream(user_question))
+                    success, ai_response = True, _split_for_telegram(str(answer))
+                except Exception as e:
+                    success, ai_response = False, f"Errore nella chiamata a OpenAI: {str(e)}"
+
+                if success and not ai_response:
+                    # Niente da inviare a Telegram: il modal resta aperto per riprovare
+                    success = False
+                    st.warning("⚠️ L'AI non ha restituito alcuna risposta, riprova.")
+                elif success:
+                    st.success("✅ Risposta ricevuta!")
+
+                    if telegram_queue is not None:
+                        if len(ai_response) == 1:
+                            telegram_queue.put(f"🤖 Risposta AI:\n{ai_response[0]}")
                         else:
-                            st.info(msg)
+                            for i, msg in enumerate(ai_response, 1):
+                                telegram_queue.put(
+                                    f"🤖 Risposta AI (parte {i}/{len(ai_response)}):\n{msg}"
+                                )
                 else:
-                    st.info(ai_response)
-
-                # Invia a Telegram se configurato
-                if (
-                    telegram_bot_token
-                    and telegram_chat_id
-                    and isinstance(ai_response, list)
-                ):
-                    messages_to_send = [f"❓ Domanda: {user_question}"]
-
-                    if len(ai_response) == 1:
-                        messages_to_send.append(f"🤖 Risposta AI:\n{ai_response[0]}")
-                    else:
-                        for i, msg in enumerate(ai_response, 1):
-                            messages_to_send.append(
-                                f"🤖 Risposta AI (parte {i}/{len(ai_response)}):\n{msg}"
-                            )
-
-                    telegram_success, telegram_msg = send_multiple_telegram_messages(
-                        telegram_bot_token, telegram_chat_id, messages_to_send
+                    st.error(ai_response)
+            finally:
+                # La coda va chiusa anche se Streamlit interrompe lo script
+                # (StopException/RerunException non derivano da Exception):
+                # altrimenti il thread di invio resta bloccato col lock della chat
+                if telegram_queue is not None:
+                    telegram_queue.put(None)
+
+            if telegram_sender is not None:
+                try:
+                    telegram_success, telegram_msg = telegram_sender.result(
+                        timeout=TELEGRAM_SENDER_TIMEOUT
+                    )
+                except FutureTimeoutError:
+                    telegram_success, telegram_msg = (
+                        False,
+                        "Invio a Telegram ancora in corso: l'esito non è disponibile",
                     )
 
-                    if telegram_success:
-                        st.success(f"📱 {telegram_msg}")
-                    else:
-                        st.warning(f"⚠️ {telegram_msg}")
+                if telegram_success:
+                    st.success(f"📱 {telegram_msg}")
+                else:
+                    st.warning(f"⚠️ {telegram_msg}")
 
+            if success:
                 st.session_state.show_ai_modal = False
                 st.rerun()
-            else:
-                st.error(ai_response)
 
         elif submit and not user_question.strip():
             st.warning("⚠️ Scrivi una domanda prima di inviare.")
@@ -382,6 +974,7 @@ def render_ai_modal(
             st.rerun()
 
 
+@st.fragment
 def render_leaf_node(node, telegram_bot_token: str, telegram_chat_id: str):
     """Renderizza una foglia della mappa concettuale"""
     st.success("📄 Hai raggiunto una foglia della mappa concettuale!")
@@ -413,30 +1006,22 @@ def render_leaf_node(node, telegram_bot_token: str, telegram_chat_id: str):
                 st.error(result_message)
 
 
-def render_category_node(children):
-    """Renderizza un nodo categoria con i suoi figli"""
+def render_category_node(children_rows):
+    """Renderizza un nodo categoria con i suoi figli, già divisi in righe di pulsanti"""
     st.subheader("📚 Sotto-argomenti disponibili:")
 
-    cols_per_row = 3
-    child_items = list(children.items())
-
-    for i in range(0, len(child_items), cols_per_row):
-        cols = st.columns(cols_per_row)
-        for j, (key, value) in enumerate(child_items[i : i + cols_per_row]):
-            with cols[j]:
-                icon = "📄" if is_leaf(value) else "📁"
-                display_name = (
-                    value.get("title", key) if isinstance(value, dict) else key
-                )
-
+    for row in children_rows:
+        cols = st.columns(CATEGORY_COLS_PER_ROW, gap="small")
+        for col, (key, icon, display_name) in zip(cols, row):
+            with col:
                 if st.button(
                     f"{icon} {display_name}", key=f"btn_{key}", use_container_width=True
                 ):
-                    st.session_state.current_path.append(key)
+                    st.session_state.current_path += (key,)
                     st.rerun()
 
 
-def render_sidebar(concept_map):
+def render_sidebar(total_nodes: int, total_leaves: int):
     """Renderizza la sidebar con informazioni e statistiche"""
     with st.sidebar:
         st.header("ℹ️ Informazioni")
@@ -458,9 +1043,6 @@ def render_sidebar(concept_map):
 
         st.markdown("---")
 
-        total_nodes = count_nodes(concept_map)
-        total_leaves = count_leaves(concept_map)
-
         st.metric("Totale nodi", total_nodes)
         st.metric("Totale foglie", total_leaves)
         st.metric("Livello corrente", len(st.session_state.current_path))
@@ -479,16 +1061,16 @@ def main():
     )
 
     # Inizializza stato sessione
-    if "current_path" not in st.session_state:
-        st.session_state.current_path = []
-    if "show_ai_modal" not in st.session_state:
-        st.session_state.show_ai_modal = False
-    if "show_search" not in st.session_state:
-        st.session_state.show_search = False
+    st.session_state.setdefault("current_path", ())
+    st.session_state.setdefault("show_ai_modal", False)
+    st.session_state.setdefault("show_search", False)
 
     # Carica configurazione
     try:
-        concept_map = load_concept_map("concept_map.json")
+        _, path_index, children_ui, leaf_paths = load_concept_map(CONCEPT_MAP_PATH)
+        # Statistiche ricavate dagli indici già caricati: nessuna visita extra
+        total_nodes = len(path_index) - 1
+        total_leaves = len(leaf_paths)
     except FileNotFoundError:
         st.error(
             "⚠️ File 'concept_map.json' non trovato. Assicurati che esista nella directory del progetto."
@@ -519,7 +1101,7 @@ def main():
 
     # Modal Ricerca
     if st.session_state.show_search:
-        render_search_bar(concept_map, TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID)
+        render_search_bar(CONCEPT_MAP_PATH, TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID)
         if st.button("❌ Chiudi Ricerca", use_container_width=False):
             st.session_state.show_search = False
             st.rerun()
@@ -532,13 +1114,13 @@ def main():
 
     # Breadcrumb navigation
     if st.session_state.current_path:
-        breadcrumb = " > ".join(["🏠 Home"] + st.session_state.current_path)
+        breadcrumb = " > ".join(("🏠 Home",) + st.session_state.current_path)
         st.markdown(f"**Percorso:** {breadcrumb}")
 
         col1, _ = st.columns([1, 5])
         with col1:
             if st.button("⬅️ Indietro"):
-                st.session_state.current_path.pop()
+                st.session_state.current_path = st.session_state.current_path[:-1]
                 st.rerun()
     else:
         st.markdown("**Percorso:** 🏠 Home")
@@ -546,11 +1128,11 @@ def main():
     st.markdown("---")
 
     # Navigazione
-    current_node = navigate_to_path(concept_map, st.session_state.current_path)
+    current_node = navigate_to_path(path_index, st.session_state.current_path)
 
     if current_node is None:
         st.error("Errore nella navigazione. Torno alla home.")
-        st.session_state.current_path = []
+        st.session_state.current_path = ()
         st.rerun()
 
     # Visualizza titolo e descrizione
@@ -560,17 +1142,17 @@ def main():
             st.info(current_node["description"])
 
     # Renderizza nodo
-    if is_leaf(current_node):
+    if st.session_state.current_path in leaf_paths:
         render_leaf_node(current_node, TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID)
     else:
-        children = get_children(current_node)
-        if children:
-            render_category_node(children)
+        node_children_ui = children_ui.get(st.session_state.current_path)
+        if node_children_ui:
+            render_category_node(node_children_ui)
         else:
             st.warning("Nessun sotto-argomento disponibile.")
 
     # Sidebar
-    render_sidebar(concept_map)
+    render_sidebar(total_nodes, total_leaves)
 
 
 if __name__ == "__main__":